@@ -1,23 +1,41 @@
 import os
+import time
 import base64
+import json
 import uuid
+from contextlib import contextmanager
+from functools import lru_cache
 from io import BytesIO
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from datetime import datetime, timedelta
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, migrate unguarded
+    fcntl = None
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, g
 from flask_login import (
     LoginManager, UserMixin, login_user, logout_user,
     current_user, login_required
 )
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
-from PIL import Image, ImageOps
+from werkzeug.security import check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from PIL import Image
+import pyvips
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 import stripe
-from sqlalchemy import text
+from sqlalchemy import text, event, func
 import qrcode
+from celery import Celery
+from celery.signals import worker_process_init
+import redis
+import boto3
 
 # --- Env & Google GenAI client ---
 load_dotenv()
@@ -25,6 +43,9 @@ client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
 
 # --- Stripe config (env) ---
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Billing routes call Stripe inline; cap how long one slow call can hold a worker thread
+stripe.default_http_client = stripe.RequestsClient(timeout=20)
+stripe.max_network_retries = 2
 APP_BASE_URL = os.getenv("APP_BASE_URL", "http://localhost:5000")
 
 # New pricing structure with multiple tiers
@@ -36,6 +57,7 @@ STRIPE_PRICE_ID_CREATOR_ANNUAL = os.getenv("STRIPE_PRICE_ID_CREATOR_ANNUAL", "pr
 STRIPE_PRICE_ID_ENTERPRISE_ANNUAL = os.getenv("STRIPE_PRICE_ID_ENTERPRISE_ANNUAL", "price_enterprise_annual")
 
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+CHECKOUT_SESSION_CACHE_TTL = 600  # seconds
 
 # Creator tier 50% off first month coupon
 STRIPE_CREATOR_COUPON = os.getenv("STRIPE_CREATOR_COUPON", "FIRSTMONTH50")
@@ -45,11 +67,23 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-change-this')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    # Sized for gunicorn gthread workers (8 threads each)
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    # Pooled connections move between threads; wait up to 30s for the SQLite write lock
+    'connect_args': {'check_same_thread': False, 'timeout': 30},
+}
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['OUTPUT_FOLDER'] = 'static/outputs'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024  # 20MB max
+# When set, browsers upload straight to the bucket via presigned PUT URLs.
+# The bucket needs a CORS rule allowing PUT (with a Content-Type header) from the site's origin.
+app.config['S3_BUCKET'] = os.getenv('S3_BUCKET')
 
 # Sessions are NOT permanent by default; be explicit:
 app.config['SESSION_PERMANENT'] = False
@@ -58,15 +92,76 @@ app.config['REMEMBER_COOKIE_SECURE'] = True       # serve over HTTPS
 app.config['REMEMBER_COOKIE_HTTPONLY'] = True
 app.config['REMEMBER_COOKIE_SAMESITE'] = "Lax"
 
+# --- Celery (background work) ---
+# Gemini calls take several seconds; run them on a dedicated worker pool:
+#   celery -A app.celery worker -Q gen -c 8
+# Webhook processing uses the default queue:
+#   celery -A app.celery worker -Q celery
+REDIS_URL = os.getenv("REDIS_URL")
+celery = Celery(
+    "studio",
+    broker=REDIS_URL or "memory://",
+    backend=REDIS_URL or "cache+memory://",
+)
+celery.conf.update(
+    # No broker configured (local dev): run tasks inline so `python app.py` still works.
+    # gunicorn.conf.py refuses to start in this mode.
+    task_always_eager=not REDIS_URL,
+    task_store_eager_result=True,
+    # Keep task args with the result so status polls can check who owns a task
+    result_extended=True,
+)
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# --- Object storage (S3 / R2) ---
+s3 = boto3.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL")) if app.config['S3_BUCKET'] else None
+S3_PATH_PREFIX = "s3:"  # stored image paths that live in the bucket rather than on disk
+
+UPLOAD_CONTENT_TYPES = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+}
+
+def sniff_image_type(head: bytes):
+    """Return the image MIME type for the first 12 bytes of a file, or None."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return 'image/jpeg'
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return 'image/png'
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return 'image/webp'
+    return None
+
+def is_image_upload(file):
+    """Check a multipart upload's magic bytes before it is written to disk."""
+    head = file.stream.read(12)
+    file.stream.seek(0)
+    return sniff_image_type(head) is not None
+
 # --- DB & Login ---
-db = SQLAlchemy(app)
+# Every write path commits explicitly; autoflush would only open SQLite write
+# transactions early on queries issued between a mutation and its commit.
+db = SQLAlchemy(app, session_options={'autoflush': False})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to continue.'
 login_manager.login_message_category = 'info'
 
+# --- Password hashing & auth rate limits ---
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+# Only trust X-Forwarded-For when a proxy is known to set it (TRUSTED_PROXY_COUNT=1
+# behind nginx); otherwise clients could forge their IP past the rate limits
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+# Password checks are deliberately expensive; cap how often one IP can trigger them
+limiter = Limiter(get_remote_address, app=app, storage_uri=REDIS_URL or "memory://")
+
 # --- Credit allocation by tier ---
 CREDITS_PER_IMAGE = 500  # Updated from 250 to 500
+FREE_GENERATIONS = 1  # Free tier gets 1 free generation for trial
 
 PLAN_CREDITS = {
     'free': 10000,        # 20 images
@@ -96,7 +191,7 @@ class User(UserMixin, db.Model):
 
     # Paywall fields
     is_subscribed = db.Column(db.Boolean, default=False, nullable=False)
-    stripe_customer_id = db.Column(db.String(120), nullable=True)
+    stripe_customer_id = db.Column(db.String(120), nullable=True, index=True)  # webhook + post-checkout lookups
     plan_tier = db.Column(db.String(20), default='free')  # 'free', 'starter', 'creator', 'enterprise', 'legacy_pro'
     
     # Credit system fields
@@ -105,13 +200,24 @@ class User(UserMixin, db.Model):
     credits_reset_date = db.Column(db.DateTime, nullable=True)
     
     # Relationship to generations
-    generations = db.relationship('Generation', backref='user', lazy=True, order_by='Generation.created_at.desc()')
+    generations = db.relationship('Generation', backref='user', lazy='dynamic', order_by='Generation.created_at.desc()')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # Accounts created before argon2id still have Werkzeug PBKDF2 hashes
+        if not self.password_hash.startswith("$argon2"):
+            return check_password_hash(self.password_hash, password)
+        try:
+            return password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def password_needs_rehash(self):
+        if not self.password_hash.startswith("$argon2"):
+            return True
+        return password_hasher.check_needs_rehash(self.password_hash)
 
 # --- Generation Model ---
 class Generation(db.Model):
@@ -119,6 +225,19 @@ class Generation(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     input_image_path = db.Column(db.String(255), nullable=False)
     output_image_path = db.Column(db.String(255), nullable=False)
+    thumb_path = db.Column(db.String(255), nullable=True)  # small WEBP for the history sidebar
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Serves the per-user history sidebar (newest first)
+db.Index('ix_gen_user_created', Generation.user_id, Generation.created_at.desc())
+
+# Sidebar only shows the most recent generations
+RECENT_GENERATIONS_LIMIT = 50
+THUMB_SIZE = (256, 256)
+
+# --- Stripe webhook events already applied (idempotency) ---
+class ProcessedEvent(db.Model):
+    event_id = db.Column(db.String(255), primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 # --- Mobile upload token model (QR flow) ---
@@ -132,7 +251,7 @@ class MobileUploadToken(db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 # --- Single white background prompt ---
 WHITE_BACKGROUND_PROMPT = """Stage this empty living room with a cohesive set of modern, minimalist furniture—low-profile sofa, area rug, coffee table, 1–2 accent chairs, and a slender floor lamp—scaled to the room and leaving clear walkways. Fill the room with an appropriate amount of furiture, do not leave odd empty space on the edges. Add contemporary art to the walls but do not change the architecture. Preserve the existing architecture, perspective, and daylight direction, and render materials (linen/bouclé, oak/walnut, stone, matte metal) with physically correct contact shadows, subtle reflections, and fine texture for a hyper-photorealistic editorial look. Make the photo vibrant like a professional realestate staging photo. Use a warm-neutral palette with one muted accent color and avoid text, logos, clutter, distortions, or floating objects. The dimensions of the output photo must be the same dimesnions of the input photo."""
@@ -165,38 +284,164 @@ def ensure_stripe_customer(user: User):
     db.session.commit()
     return user.stripe_customer_id
 
+def apply_plan(customer_id, tier, is_subscribed):
+    """Set a customer's plan and reset their credits in one UPDATE; returns the number of users matched."""
+    res = db.session.execute(
+        db.update(User)
+        .where(User.stripe_customer_id == customer_id)
+        .values(
+            is_subscribed=is_subscribed,
+            plan_tier=tier,
+            credits_remaining=PLAN_CREDITS[tier],
+            credits_limit=PLAN_CREDITS[tier],
+        )
+    )
+    return res.rowcount
+
+def resolve_checkout_session(session_id):
+    """Return (customer_id, tier) for a Checkout Session.
+
+    post-checkout and the checkout.session.completed webhook both need this for
+    the same session; the result is cached so only the first pays for the
+    Stripe round trip.
+    """
+    cache_key = f"stripe:checkout:{session_id}"
+    if redis_client:
+        cached = redis_client.get(cache_key)
+        if cached:
+            data = json.loads(cached)
+            return data["customer"], data["tier"]
+
+    sess = stripe.checkout.Session.retrieve(session_id, expand=['line_items'])
+    customer_id = sess.get("customer")
+
+    # Get the price ID to determine which tier was purchased
+    price_id = None
+    if sess.get('line_items') and sess['line_items'].get('data'):
+        price_id = sess['line_items']['data'][0]['price']['id']
+    tier = PRICE_ID_TO_TIER.get(price_id, 'creator')  # Default to creator if unknown
+
+    if redis_client:
+        redis_client.setex(cache_key, CHECKOUT_SESSION_CACHE_TTL, json.dumps({"customer": customer_id, "tier": tier}))
+    return customer_id, tier
+
+# --- SQLite tuning ---
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",       # readers don't block on the writer
+    "synchronous=NORMAL",     # safe with WAL, one fsync per checkpoint instead of per commit
+    "temp_store=MEMORY",
+    "mmap_size=268435456",    # 256MB
+    "cache_size=-64000",      # 64MB
+    "foreign_keys=ON",
+)
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cur = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cur.execute("PRAGMA " + pragma)
+    cur.close()
+
+# --- Generated image storage ---
+def save_output_image(image, filename, **save_kwargs):
+    """Store a generated image in the bucket if configured, else OUTPUT_FOLDER; returns its stored path."""
+    if s3:
+        buf = BytesIO()
+        image.save(buf, **save_kwargs)
+        key = f"outputs/{filename}"
+        s3.put_object(
+            Bucket=app.config['S3_BUCKET'],
+            Key=key,
+            Body=buf.getvalue(),
+            ContentType=Image.MIME[save_kwargs["format"]],
+            CacheControl="private, max-age=31536000, immutable",
+        )
+        return S3_PATH_PREFIX + key
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+    image.save(output_path, **save_kwargs)
+    return "/" + output_path.replace("\\", "/")
+
+def save_thumbnail(image, output_filename):
+    """Store a sidebar-sized WEBP alongside an output image and return its stored path."""
+    thumb = image.copy()
+    thumb.thumbnail(THUMB_SIZE, Image.LANCZOS)
+    thumb_filename = os.path.splitext(output_filename)[0] + "_thumb.webp"
+    return save_output_image(thumb, thumb_filename, format="WEBP", quality=80, method=6)
+
+@celery.task
+def backfill_thumbnails(generation_ids):
+    """Create sidebar thumbnails for generations made before they existed."""
+    with app.app_context():
+        generations = Generation.query.filter(
+            Generation.id.in_(generation_ids), Generation.thumb_path.is_(None)
+        ).all()
+        for gen in generations:
+            output_path = gen.output_image_path.lstrip("/")
+            try:
+                with Image.open(output_path) as img:
+                    gen.thumb_path = save_thumbnail(img, os.path.basename(output_path))
+            except (OSError, Image.DecompressionBombError):
+                # Missing or unreadable output: show it as-is and don't retry
+                gen.thumb_path = gen.output_image_path
+        db.session.commit()
+
+def queue_thumbnail_backfill(generations):
+    """Queue thumbnail backfill; the sidebar shows the full output until it lands."""
+    missing = [
+        gen.id for gen in generations
+        if not gen.thumb_path and gen.output_image_path.startswith("/")
+    ]
+    if missing:
+        backfill_thumbnails.delay(missing)
+
 # --- lightweight auto-migration for SQLite ---
-def _column_exists(table: str, column: str) -> bool:
+@contextmanager
+def _migration_lock():
+    """Only one process migrates at a time when several workers boot together."""
+    os.makedirs(app.instance_path, exist_ok=True)
+    with open(os.path.join(app.instance_path, "migrate.lock"), "w") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def _table_columns(table: str) -> set:
     res = db.session.execute(text(f"PRAGMA table_info({table})")).fetchall()
-    return any(row[1] == column for row in res)
+    return {row[1] for row in res}
+
+def _column_exists(table: str, column: str) -> bool:
+    return column in _table_columns(table)
 
 def _table_exists(table: str) -> bool:
     res = db.session.execute(text("SELECT name FROM sqlite_master WHERE type='table' AND name=:table"), {"table": table}).fetchall()
     return len(res) > 0
 
+PAYWALL_COLUMNS = {
+    "is_subscribed": "BOOLEAN NOT NULL DEFAULT 0",
+    "stripe_customer_id": "VARCHAR(120)",
+    "plan_tier": "VARCHAR(20) DEFAULT 'free'",
+    "credits_remaining": "INTEGER DEFAULT 10000",
+    "credits_limit": "INTEGER DEFAULT 10000",
+    "credits_reset_date": "DATETIME",
+}
+
 def ensure_paywall_columns():
-    added = False
-    if not _column_exists("user", "is_subscribed"):
-        db.session.execute(text("ALTER TABLE user ADD COLUMN is_subscribed BOOLEAN NOT NULL DEFAULT 0"))
-        added = True
-    if not _column_exists("user", "stripe_customer_id"):
-        db.session.execute(text("ALTER TABLE user ADD COLUMN stripe_customer_id VARCHAR(120)"))
-        added = True
-    if not _column_exists("user", "plan_tier"):
-        db.session.execute(text("ALTER TABLE user ADD COLUMN plan_tier VARCHAR(20) DEFAULT 'free'"))
-        added = True
-    if not _column_exists("user", "credits_remaining"):
-        db.session.execute(text("ALTER TABLE user ADD COLUMN credits_remaining INTEGER DEFAULT 10000"))
-        added = True
-    if not _column_exists("user", "credits_limit"):
-        db.session.execute(text("ALTER TABLE user ADD COLUMN credits_limit INTEGER DEFAULT 10000"))
-        added = True
-    if not _column_exists("user", "credits_reset_date"):
-        db.session.execute(text("ALTER TABLE user ADD COLUMN credits_reset_date DATETIME"))
-        added = True
-    if added:
+    existing = _table_columns("user")
+    missing = [(column, ddl) for column, ddl in PAYWALL_COLUMNS.items() if column not in existing]
+    for column, ddl in missing:
+        db.session.execute(text(f"ALTER TABLE user ADD COLUMN {column} {ddl}"))
+    if missing:
+        db.session.commit()
+
+def ensure_generation_columns():
+    if not _column_exists("generation", "thumb_path"):
+        db.session.execute(text("ALTER TABLE generation ADD COLUMN thumb_path VARCHAR(255)"))
         db.session.commit()
 
+def ensure_indexes():
+    # create_all() only builds indexes for new tables; add them to existing DBs too
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_gen_user_created ON generation (user_id, created_at DESC)"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_user_stripe_customer_id ON user (stripe_customer_id)"))
+    db.session.commit()
+
 # --- Jinja filters ---
 @app.template_filter('format_number')
 def format_number(value):
@@ -206,6 +451,45 @@ def format_number(value):
     except (ValueError, TypeError):
         return value
 
+# Presigned GET URLs are reused for a whole window so the browser's immutable
+# cache can hit; each one stays valid for at least a window after it's handed out.
+MEDIA_URL_WINDOW = 3600
+
+@lru_cache(maxsize=4096)
+def _presigned_media_url(key, window):
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": app.config['S3_BUCKET'], "Key": key},
+        ExpiresIn=2 * MEDIA_URL_WINDOW,
+    )
+
+@app.template_filter('media_url')
+def media_url(path):
+    """Resolve a stored image path to a URL the browser can load"""
+    if path and path.startswith(S3_PATH_PREFIX):
+        return _presigned_media_url(path[len(S3_PATH_PREFIX):], int(time.time() // MEDIA_URL_WINDOW))
+    return path
+
+# --- Request-scoped user state ---
+def user_state():
+    """Auth/subscription/free-use flags for the current user, computed once per request."""
+    if "user_state" not in g:
+        is_authed = bool(current_user.is_authenticated)
+        is_subscribed = bool(current_user.is_subscribed) if is_authed else False
+        free_uses_left = None
+        if is_authed and not is_subscribed:
+            free_uses_left = max(0, FREE_GENERATIONS - (current_user.generation_count or 0))
+        g.user_state = {
+            "is_authed": is_authed,
+            "is_subscribed": is_subscribed,
+            "free_uses_left": free_uses_left,
+        }
+    return g.user_state
+
+@app.context_processor
+def inject_user_state():
+    return user_state()
+
 # -----------------------
 # Marketing Pages
 # -----------------------
@@ -223,6 +507,7 @@ def pricing():
 # Auth Routes
 # -----------------------
 @app.route("/signup", methods=["GET", "POST"])
+@limiter.limit("10/minute", methods=["POST"])
 def signup():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -254,6 +539,7 @@ def signup():
     return render_template("signup.html")
 
 @app.route("/login", methods=["GET", "POST"])
+@limiter.limit("10/minute", methods=["POST"])
 def login():
     if current_user.is_authenticated:
         return redirect(request.args.get('next') or url_for('index'))
@@ -265,6 +551,10 @@ def login():
 
         user = User.query.filter_by(email=email).first()
         if user and user.check_password(password):
+            # Upgrade legacy PBKDF2 hashes now that we have the plaintext
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
             remember = bool(request.form.get("remember"))
             login_user(user, remember=remember)
             return redirect(next_page)
@@ -351,25 +641,11 @@ def post_checkout():
         return redirect(url_for('index'))
 
     try:
-        sess = stripe.checkout.Session.retrieve(session_id, expand=['line_items'])
-        customer_id = sess.get("customer")
+        customer_id, tier = resolve_checkout_session(session_id)
         if not customer_id:
             raise ValueError("No Stripe customer on session")
 
-        # Get the price ID to determine which tier was purchased
-        price_id = None
-        if sess.get('line_items') and sess['line_items'].get('data'):
-            price_id = sess['line_items']['data'][0]['price']['id']
-
-        # Determine tier from price ID
-        tier = PRICE_ID_TO_TIER.get(price_id, 'creator')  # Default to creator if unknown
-
-        user = User.query.filter_by(stripe_customer_id=customer_id).first()
-        if user:
-            user.is_subscribed = True
-            user.plan_tier = tier
-            user.credits_remaining = PLAN_CREDITS[tier]
-            user.credits_limit = PLAN_CREDITS[tier]
+        if apply_plan(customer_id, tier, is_subscribed=True):
             db.session.commit()
         elif current_user.is_authenticated:
             current_user.stripe_customer_id = customer_id
@@ -395,67 +671,69 @@ def billing_portal():
     )
     return redirect(session.url, code=303)
 
+def _handle_checkout_completed(data):
+    customer_id = data.get("customer")
+
+    # Tier comes from the session's line items (shared cache with post-checkout)
+    if customer_id:
+        _, tier = resolve_checkout_session(data['id'])
+        apply_plan(customer_id, tier, is_subscribed=True)
+
+def _handle_subscription_change(data):
+    customer_id = data.get("customer")
+    status = data.get("status")
+
+    if customer_id:
+        # Get price ID from subscription items
+        price_id = None
+        if data.get('items') and data['items'].get('data'):
+            price_id = data['items']['data'][0]['price']['id']
+
+        tier = PRICE_ID_TO_TIER.get(price_id, 'creator')
+
+        is_active = status in ("active", "trialing")
+        if is_active:
+            apply_plan(customer_id, tier, is_subscribed=True)
+        else:
+            # Subscription cancelled - revert to free
+            apply_plan(customer_id, 'free', is_subscribed=False)
+
+# Stripe event type -> handler for the event's data.object
+STRIPE_EVENT_HANDLERS = {
+    "checkout.session.completed": _handle_checkout_completed,
+    "customer.subscription.updated": _handle_subscription_change,
+    "customer.subscription.deleted": _handle_subscription_change,
+}
+
+# The webhook is acknowledged before this runs, so Stripe won't redeliver on
+# failure; retry here instead (backoff up to ~10 minutes)
+@celery.task(autoretry_for=(Exception,), retry_backoff=True, retry_backoff_max=600, max_retries=8)
+def process_stripe_event(event):
+    """Apply a verified Stripe webhook event to the matching user."""
+    with app.app_context():
+        # Stripe redelivers events; each one is applied once
+        if db.session.get(ProcessedEvent, event["id"]):
+            return
+
+        handler = STRIPE_EVENT_HANDLERS.get(event["type"])
+        if handler:
+            handler(event["data"]["object"])
+
+        # Only reached if the handler succeeded; recorded in the same commit as its changes
+        db.session.add(ProcessedEvent(event_id=event["id"]))
+        db.session.commit()
+
 @app.post("/stripe/webhook")
 def stripe_webhook():
     payload = request.get_data(as_text=True)
     sig_header = request.headers.get("Stripe-Signature", "")
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
     except Exception as e:
         return jsonify(success=False, error=str(e)), 400
 
-    if event["type"] == "checkout.session.completed":
-        data = event["data"]["object"]
-        customer_id = data.get("customer")
-        
-        # Get price ID from line items
-        if customer_id:
-            try:
-                session = stripe.checkout.Session.retrieve(data['id'], expand=['line_items'])
-                price_id = None
-                if session.get('line_items') and session['line_items'].get('data'):
-                    price_id = session['line_items']['data'][0]['price']['id']
-                
-                tier = PRICE_ID_TO_TIER.get(price_id, 'creator')
-                
-                user = User.query.filter_by(stripe_customer_id=customer_id).first()
-                if user:
-                    user.is_subscribed = True
-                    user.plan_tier = tier
-                    user.credits_remaining = PLAN_CREDITS[tier]
-                    user.credits_limit = PLAN_CREDITS[tier]
-                    db.session.commit()
-            except Exception as e:
-                print(f"Error processing checkout.session.completed: {e}")
-
-    if event["type"] in ("customer.subscription.updated", "customer.subscription.deleted"):
-        data = event["data"]["object"]
-        customer_id = data.get("customer")
-        status = data.get("status")
-        
-        if customer_id:
-            # Get price ID from subscription items
-            price_id = None
-            if data.get('items') and data['items'].get('data'):
-                price_id = data['items']['data'][0]['price']['id']
-            
-            tier = PRICE_ID_TO_TIER.get(price_id, 'creator')
-            
-            user = User.query.filter_by(stripe_customer_id=customer_id).first()
-            if user:
-                is_active = status in ("active", "trialing")
-                user.is_subscribed = is_active
-                if is_active:
-                    user.plan_tier = tier
-                    user.credits_remaining = PLAN_CREDITS[tier]
-                    user.credits_limit = PLAN_CREDITS[tier]
-                else:
-                    # Subscription cancelled - revert to free
-                    user.plan_tier = 'free'
-                    user.credits_remaining = PLAN_CREDITS['free']
-                    user.credits_limit = PLAN_CREDITS['free']
-                db.session.commit()
-
+    # Acknowledge right away; Stripe retries deliveries that take more than a few seconds
+    process_stripe_event.delay(json.loads(payload))
     return jsonify(success=True), 200
 
 # -----------------------
@@ -466,17 +744,10 @@ def index():
     if request.args.get("upgraded") == "1":
         flash("Thanks for upgrading! Your subscription is now active.", "success")
 
-    is_authed = bool(current_user.is_authenticated) if current_user else False
-    is_subscribed = bool(getattr(current_user, "is_subscribed", False)) if is_authed else False
-
-    # Free tier gets 1 free generation for trial (20 images worth of credits = 10,000)
-    free_cap = 1
-    used = int(getattr(current_user, "generation_count", 0)) if is_authed else 0
-    free_uses_left = max(0, free_cap - used) if not is_subscribed and is_authed else None
-    
     user_generations = []
-    if is_authed:
-        user_generations = current_user.generations
+    if user_state()["is_authed"]:
+        user_generations = current_user.generations.limit(RECENT_GENERATIONS_LIMIT).all()
+        queue_thumbnail_backfill(user_generations)
 
     return render_template(
         "index.html",
@@ -484,9 +755,6 @@ def index():
         input_image=None,
         output_image=None,
         error=None,
-        is_authed=is_authed,
-        is_subscribed=is_subscribed,
-        free_uses_left=free_uses_left,
         user_generations=user_generations,
     )
 
@@ -503,7 +771,8 @@ def view_generation(generation_id):
         flash("Generation not found.", "error")
         return redirect(url_for('index'))
     
-    user_generations = current_user.generations
+    user_generations = current_user.generations.limit(RECENT_GENERATIONS_LIMIT).all()
+    queue_thumbnail_backfill(user_generations)
     
     return render_template(
         "index.html",
@@ -511,9 +780,6 @@ def view_generation(generation_id):
         input_image=generation.input_image_path,
         output_image=generation.output_image_path,
         error=None,
-        is_authed=True,
-        is_subscribed=current_user.is_subscribed,
-        free_uses_left=None,
         user_generations=user_generations,
         selected_generation_id=generation_id,
     )
@@ -521,110 +787,231 @@ def view_generation(generation_id):
 # -----------------------
 # Transform Action
 # -----------------------
-@app.post("/transform")
-def transform():
-    if not current_user.is_authenticated:
-        return redirect(url_for('signup', next=url_for('index')))
+def reserve_credits(user_id):
+    """Atomically take one image's worth of credits; False if the user can't afford it."""
+    res = db.session.execute(
+        db.update(User)
+        .where(User.id == user_id, User.credits_remaining >= CREDITS_PER_IMAGE)
+        .values(
+            credits_remaining=User.credits_remaining - CREDITS_PER_IMAGE,
+            generation_count=func.coalesce(User.generation_count, 0) + 1,
+        )
+    )
+    db.session.commit()
+    return res.rowcount == 1
+
+def release_credits(user_id):
+    """Give back credits reserved for a generation that failed."""
+    db.session.execute(
+        db.update(User)
+        .where(User.id == user_id)
+        .values(
+            credits_remaining=User.credits_remaining + CREDITS_PER_IMAGE,
+            generation_count=User.generation_count - 1,
+        )
+    )
+    db.session.commit()
 
-    # Check credits
-    if current_user.credits_remaining < CREDITS_PER_IMAGE:
-        if current_user.is_subscribed:
-            flash("You've used all your monthly credits. They'll reset at the start of next month.", "info")
-        else:
-            flash("You've used all your free credits. Upgrade to continue.", "info")
-        return redirect(url_for('upgrade'))
+def flash_out_of_credits():
+    if current_user.is_subscribed:
+        flash("You've used all your monthly credits. They'll reset at the start of next month.", "info")
+    else:
+        flash("You've used all your free credits. Upgrade to continue.", "info")
+
+def _generate_image(user_id, input_path, filename, input_key):
+    # Resize: keep aspect ratio; longest side = 1024 px.
+    # libvips shrinks during JPEG decode and applies EXIF orientation, so the
+    # full-resolution raster is never held in memory.
+    if input_key:
+        obj = s3.get_object(Bucket=app.config['S3_BUCKET'], Key=input_key)
+        # A presigned PUT can't bound the object size, so check it before reading
+        if obj["ContentLength"] > app.config['MAX_CONTENT_LENGTH']:
+            obj["Body"].close()
+            raise ValueError("Image is too large.")
+        data = obj["Body"].read()
+        # The browser uploaded this directly, so it hasn't been checked yet
+        if not sniff_image_type(data[:12]):
+            raise ValueError("Unsupported image type.")
+        input_image = S3_PATH_PREFIX + input_key
+        thumb = pyvips.Image.thumbnail_buffer(data, 1024, height=1024)
+    else:
+        input_image = "/" + input_path.replace("\\", "/")
+        thumb = pyvips.Image.thumbnail(input_path, 1024, height=1024)
+    # Hand Gemini the encoded JPEG as-is rather than a PIL image it would re-encode
+    image_part = types.Part.from_bytes(
+        data=thumb.write_to_buffer('.jpg[Q=90,optimize_coding,strip]'),
+        mime_type="image/jpeg",
+    )
 
-    input_image = None
-    output_image = None
-    error = None
+    # Use Google Generative AI
+    response = client.models.generate_content(
+        model="gemini-2.5-flash-image-preview",
+        contents=[image_part, WHITE_BACKGROUND_PROMPT],
+    )
 
-    file = request.files.get("image")
-    if not file or not file.filename:
-        flash("Please choose an image to upload.", "error")
-        return redirect(url_for('index'))
+    image_parts = [
+        part.inline_data.data
+        for part in response.candidates[0].content.parts
+        if part.inline_data
+    ]
 
-    try:
-        filename = secure_filename(file.filename)
-        if not filename:
-            raise ValueError("Invalid filename.")
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{filename}"
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(input_path)
-        input_image = "/" + input_path.replace("\\", "/")
+    if not image_parts:
+        raise ValueError("No image was generated in the response")
 
-        # Resize: keep aspect ratio; longest side = 1024 px
-        with Image.open(input_path) as img:
-            img = ImageOps.exif_transpose(img).convert("RGB")
-            w, h = img.size
-            longest = max(w, h)
-            scale = 1024.0 / float(longest) if longest != 0 else 1.0
-            new_w = max(1, int(round(w * scale)))
-            new_h = max(1, int(round(h * scale)))
-            img = img.resize((new_w, new_h), Image.LANCZOS)
-
-            # Use Google Generative AI
-            response = client.models.generate_content(
-                model="gemini-2.5-flash-image-preview",
-                contents=[img, WHITE_BACKGROUND_PROMPT],
-            )
-            
-            image_parts = [
-                part.inline_data.data
-                for part in response.candidates[0].content.parts
-                if part.inline_data
-            ]
-            
-            if not image_parts:
-                raise ValueError("No image was generated in the response")
-            
-            generated_image = Image.open(BytesIO(image_parts[0]))
-            base_name, _ = os.path.splitext(filename)
-            safe_base = secure_filename(base_name) or "output"
-            output_filename = f"genai_white_{safe_base}.png"
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-            generated_image.save(output_path, format="PNG")
-            output_image = "/" + output_path.replace("\\", "/")
+    generated_image = Image.open(BytesIO(image_parts[0]))
+    base_name, _ = os.path.splitext(filename)
+    safe_base = secure_filename(base_name) or "output"
+    output_filename = f"genai_white_{safe_base}.png"
+    output_image = save_output_image(generated_image, output_filename, format="PNG")
+    thumb_image = save_thumbnail(generated_image, output_filename)
 
+    with app.app_context():
         generation = Generation(
-            user_id=current_user.id,
+            user_id=user_id,
             input_image_path=input_image,
             output_image_path=output_image,
+            thumb_path=thumb_image,
         )
         db.session.add(generation)
-        
-        # Deduct credits
-        current_user.credits_remaining = max(0, current_user.credits_remaining - CREDITS_PER_IMAGE)
-        current_user.generation_count = (current_user.generation_count or 0) + 1
         db.session.commit()
 
-    except Exception as e:
-        error = f"Error generating image: {str(e)}"
-        flash(error, "error")
-
-    is_authed = True
-    is_subscribed = bool(getattr(current_user, "is_subscribed", False))
-    free_cap = 1
-    used = int(getattr(current_user, "generation_count", 0))
-    free_uses_left = max(0, free_cap - used) if not is_subscribed else None
-    
-    user_generations = current_user.generations
+        return {
+            "user_id": user_id,
+            "generation_id": generation.id,
+            "input_image": input_image,
+            "output_image": output_image,
+        }
 
-    return render_template(
-        "index.html",
-        user=current_user,
-        input_image=input_image,
-        output_image=output_image,
-        error=error,
-        is_authed=is_authed,
-        is_subscribed=is_subscribed,
-        free_uses_left=free_uses_left,
-        user_generations=user_generations,
+@celery.task(queue="gen")
+def generate_image_task(user_id, input_path, filename, input_key=None):
+    """Generate the staged image for an upload (local file or bucket key) and record the Generation."""
+    try:
+        return _generate_image(user_id, input_path, filename, input_key)
+    except Exception:
+        with app.app_context():
+            release_credits(user_id)
+        raise
+
+@app.post("/transform")
+def transform():
+    if not current_user.is_authenticated:
+        return redirect(url_for('signup', next=url_for('index')))
+
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+
+    # Direct upload: the browser already PUT the file into the bucket
+    key = request.form.get("key")
+    file = request.files.get("image")
+    if key and s3:
+        if not key.startswith(f"uploads/{current_user.id}/"):
+            flash("Error generating image: Invalid upload.", "error")
+            return redirect(url_for('index'))
+        filename = f"{timestamp}_{os.path.basename(key)}"
+    else:
+        if not file or not file.filename:
+            flash("Please choose an image to upload.", "error")
+            return redirect(url_for('index'))
+        filename = secure_filename(file.filename)
+        if not filename:
+            flash("Error generating image: Invalid filename.", "error")
+            return redirect(url_for('index'))
+        if not is_image_upload(file):
+            return jsonify(error="Unsupported image type. Please upload a JPEG, PNG or WEBP."), 415
+        filename = f"{timestamp}_{filename}"
+
+    # Charge up front in one conditional UPDATE so overlapping requests can't
+    # overspend, and we never pay for a Gemini call the user can't afford
+    if not reserve_credits(current_user.id):
+        flash_out_of_credits()
+        return redirect(url_for('upgrade'))
+
+    try:
+        if key and s3:
+            task = generate_image_task.delay(current_user.id, None, filename, input_key=key)
+        else:
+            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            file.save(input_path)
+            task = generate_image_task.delay(current_user.id, input_path, filename)
+    except Exception:
+        release_credits(current_user.id)
+        raise
+    return jsonify(task_id=task.id)
+
+@app.post("/upload/presign")
+def upload_presign():
+    """Hand the browser a short-lived URL to PUT its image straight into the bucket."""
+    if not s3:
+        return jsonify({"ok": False, "error": "direct_upload_disabled"}), 404
+    # Called via fetch, so answer with JSON the client can follow instead of a login redirect
+    if not current_user.is_authenticated:
+        return jsonify({"ok": False, "redirect": url_for('signup', next=url_for('index'))}), 401
+    # Don't let a user who can't afford the generation upload into the bucket first
+    if (current_user.credits_remaining or 0) < CREDITS_PER_IMAGE:
+        flash_out_of_credits()
+        return jsonify({"ok": False, "redirect": url_for('upgrade')}), 402
+
+    content_type = (request.get_json(silent=True) or {}).get("content_type")
+    ext = UPLOAD_CONTENT_TYPES.get(content_type)
+    if not ext:
+        return jsonify({"ok": False, "error": "unsupported_type"}), 415
+
+    key = f"uploads/{current_user.id}/{uuid.uuid4().hex}{ext}"
+    url = s3.generate_presigned_url(
+        "put_object",
+        Params={"Bucket": app.config['S3_BUCKET'], "Key": key, "ContentType": content_type},
+        ExpiresIn=300,
     )
+    return jsonify({"ok": True, "key": key, "url": url})
+
+@app.get("/transform/status/<task_id>")
+@login_required
+def transform_status(task_id):
+    """Polled by the client until the generation task finishes."""
+    result = generate_image_task.AsyncResult(task_id)
+    if result.state == "SUCCESS":
+        data = result.result
+        if data["user_id"] != current_user.id:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        return jsonify({
+            "ok": True,
+            "ready": True,
+            "state": result.state,
+            "output_image": media_url(data["output_image"]),
+            "redirect_url": url_for('view_generation', generation_id=data["generation_id"]),
+        })
+    if result.state == "FAILURE":
+        # The error text can carry Gemini/S3 details; only the owner gets to see it
+        if not result.args or result.args[0] != current_user.id:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        return jsonify({
+            "ok": False,
+            "ready": True,
+            "state": result.state,
+            "error": f"Error generating image: {result.result}",
+        })
+    return jsonify({"ok": True, "ready": False, "state": result.state})
 
 # -----------------------
 # Mobile Upload (QR flow)
 # -----------------------
+MOBILE_TOKEN_TTL = timedelta(hours=1)
+
+@celery.task
+def cleanup_mobile_tokens():
+    """Delete QR upload tokens older than MOBILE_TOKEN_TTL."""
+    with app.app_context():
+        cutoff = datetime.utcnow() - MOBILE_TOKEN_TTL
+        MobileUploadToken.query.filter(MobileUploadToken.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+# Run by `celery -A app.celery beat`
+celery.conf.beat_schedule = {
+    "cleanup-mobile-tokens": {
+        "task": cleanup_mobile_tokens.name,
+        "schedule": 600.0,  # every 10 minutes
+    },
+}
+
 @app.post("/mobile/start")
 def mobile_start():
     t = MobileUploadToken(
@@ -641,14 +1028,19 @@ def mobile_start():
         "qrcode_url": url_for("mobile_qrcode", token=t.token, _external=True)
     })
 
+@lru_cache(maxsize=1024)
+def _render_qr(url):
+    buf = BytesIO()
+    qrcode.make(url).save(buf, format="PNG")
+    return buf.getvalue()
+
 @app.get("/mobile/qrcode/<token>")
 def mobile_qrcode(token):
     url = f"{APP_BASE_URL}/mobile/upload/{token}"
-    img = qrcode.make(url)
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return send_file(buf, mimetype="image/png")
+    response = send_file(BytesIO(_render_qr(url)), mimetype="image/png")
+    # A token's URL never changes, so neither does its QR code
+    response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+    return response
 
 @app.get("/mobile/upload/<token>")
 def mobile_upload_get(token):
@@ -667,6 +1059,8 @@ def mobile_upload_post(token):
     if not f or not f.filename:
         flash("Please choose a photo.", "error")
         return render_template("mobile_upload.html", token=token)
+    if not is_image_upload(f):
+        return "Unsupported image type.", 415
 
     filename = secure_filename(f.filename) or f"{token}.jpg"
     path = os.path.join(app.config['UPLOAD_FOLDER'], f"mobile_{token}_{filename}")
@@ -687,18 +1081,32 @@ def mobile_status(token):
 
 # --- Initialize DB ---
 with app.app_context():
-    db.create_all()
-    ensure_paywall_columns()
-    
-    # Grandfather existing Pro users to 'legacy_pro' tier
-    legacy_users = User.query.filter_by(is_subscribed=True).filter(
-        (User.plan_tier == None) | (User.plan_tier == '')
-    ).all()
-    for user in legacy_users:
-        if user.credits_limit == 200000:  # Old Pro plan
-            user.plan_tier = 'legacy_pro'
-    if legacy_users:
-        db.session.commit()
+    if db.engine.dialect.name == "sqlite":
+        event.listen(db.engine, "connect", _sqlite_pragmas)
+    with _migration_lock():
+        db.create_all()
+        ensure_paywall_columns()
+        ensure_generation_columns()
+        ensure_indexes()
+
+        # Grandfather existing Pro users to 'legacy_pro' tier
+        legacy_users = User.query.filter_by(is_subscribed=True).filter(
+            (User.plan_tier == None) | (User.plan_tier == '')
+        ).all()
+        for user in legacy_users:
+            if user.credits_limit == 200000:  # Old Pro plan
+                user.plan_tier = 'legacy_pro'
+        if legacy_users:
+            db.session.commit()
+    # Don't hand the startup connection to forked gunicorn/Celery children
+    db.session.remove()
+    db.engine.dispose()
+
+@worker_process_init.connect
+def _reset_db_pool(**kwargs):
+    """Prefork children must open their own SQLite connections, never the parent's."""
+    with app.app_context():
+        db.engine.dispose(close=False)
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
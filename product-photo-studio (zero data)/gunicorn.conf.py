@@ -0,0 +1,23 @@
+# Gunicorn config: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Without a broker app.py runs Celery tasks inline and keeps results in
+# per-process memory: generations would block web threads past the timeout and
+# status polls served by another worker would never see them finish.
+if not os.getenv("REDIS_URL"):
+    raise RuntimeError("REDIS_URL must be set when serving with gunicorn (eager Celery is for `python app.py` only)")
+
+# Loopback only: nginx (nginx.conf) is the public entry point
+bind = os.getenv("BIND", "127.0.0.1:8000")
+
+# Threaded workers: a Stripe round trip parks one thread, not the whole worker.
+# Image generation runs on the Celery 'gen' queue, so web threads only wait on short I/O.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = 30